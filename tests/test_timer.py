@@ -1,8 +1,12 @@
+import importlib
 import io
 import time
 
 from ttimer.timer import Timer, get_timer, timer
 
+# ttimer.timer (the module) is shadowed by the re-exported timer decorator
+timer_module = importlib.import_module("ttimer.timer")
+
 
 def test_nested():
     t = Timer()
@@ -86,6 +90,92 @@ def test_records():
     assert t.records[3].name == "d"
 
 
+def test_records_after_update():
+    t = Timer()
+
+    with t("a"):
+        pass
+
+    assert [r.count for r in t.records] == [1]
+
+    with t("a"):
+        with t("b"):
+            pass
+
+    assert [r.count for r in t.records] == [2, 1]
+
+
+def test_returned_values_are_copies():
+    t = Timer()
+
+    with t("a"):
+        pass
+
+    t.records[0].count = 999
+    t.nodes.clear()
+
+    assert t.records[0].count == 1
+    assert t.render(flat=True).splitlines()[2].split()[:2] == ["a", "1"]
+    assert len(t.nodes) == 1
+
+
+def test_query_inside_block(monkeypatch):
+    monkeypatch.setattr(timer_module, "_MAX_PENDING_EVENTS", 3)
+    t = Timer()
+
+    with t("a"):
+        for _ in range(5):
+            with t("b"):
+                pass
+        assert len(t._events) < 3
+        assert t["a"].count == 0
+        assert t["b"].count == 5
+
+    assert t["a"].count == 1
+    assert t["a"].time >= t["b"].time
+
+
+def test_clear():
+    t = Timer()
+
+    with t("a"):
+        with t("b"):
+            pass
+
+    t.clear()
+    assert t.nodes == []
+    assert t.records == []
+
+    with t("c"):
+        with t("b"):
+            pass
+        with t("d"):
+            pass
+
+    assert [n.stack for n in t.nodes] == [("c",), ("c", "b"), ("c", "d")]
+    assert [len(n.children) for n in t.nodes] == [2, 0, 0]
+    assert t["b"].count == 1
+    assert t["d"].count == 1
+
+
+def test_clear_keeps_returned_nodes():
+    t = Timer()
+
+    with t("a"):
+        pass
+
+    node = t.nodes[0]
+    t.clear()
+
+    with t("zzz"):
+        pass
+
+    assert node.record.name == "a"
+    assert node.stack == ("a",)
+    assert t.nodes[0] is not node
+    assert t.nodes[0].stack == ("zzz",)
+
+
 def test_auto_name():
     t = Timer()
 
@@ -104,6 +194,18 @@ def test_auto_name():
     assert t.nodes[1].record.name != t.nodes[2].record.name
 
 
+def test_auto_name_same_function_in_different_files():
+    t = Timer()
+    source = "def work(t):\n    with t:\n        pass\n"
+
+    for filename in ["mod_a.py", "mod_b.py"]:
+        namespace = {}  # type: dict
+        exec(compile(source, filename, "exec"), namespace)
+        namespace["work"](t)
+
+    assert [n.record.name for n in t.nodes] == ["work(mod_a.py:2)", "work(mod_b.py:2)"]
+
+
 def test_auto_name_nested():
     t = Timer()
 
@@ -120,6 +222,53 @@ def test_auto_name_nested():
     assert len(set([n.record.name for n in t.nodes])) == 4
 
 
+def test_single_with_statement():
+    t = Timer()
+
+    with t("a"), t("b"):
+        with t:
+            pass
+
+    assert len(t.nodes) == 3
+    assert t.nodes[1].stack == ("a", "b")
+    assert t.nodes[2].stack[-1].startswith("test_single_with_statement(test_timer.py:")
+
+
+def test_reuse_context():
+    t = Timer()
+
+    ctx = t("step")
+    for _ in range(3):
+        with ctx:
+            pass
+
+    assert len(t.nodes) == 1
+    assert t["step"].count == 3
+
+
+def test_context_created_in_advance():
+    t = Timer()
+
+    a = t("a")
+    b = t("b")
+    with a:
+        with b:
+            pass
+
+    assert [n.stack for n in t.nodes] == [("a",), ("a", "b")]
+
+
+def test_unentered_context():
+    t = Timer()
+
+    t("x")
+    with t:
+        pass
+
+    assert len(t.nodes) == 1
+    assert t.nodes[0].record.name.startswith("test_unentered_context(test_timer.py:")
+
+
 @timer("abc")
 def func(a: int) -> None:
     pass
@@ -200,6 +349,22 @@ def test_render():
     print(t.render())
     print(t.render(flat=True))
 
+    lines = t.render().splitlines()
+    assert len(lines) == 5
+    assert lines[0].split() == ["path", "count", "time", "own", "time", "cpu", "time", "own", "cpu", "time"]
+    assert lines[2].split()[:2] == ["a", "1"]
+    assert lines[3].split()[:3] == ["└──", "b", "10"]
+    assert lines[4].split()[:2] == ["b", "1"]
+
+    lines = t.render(flat=True).splitlines()
+    assert len(lines) == 4
+    assert lines[3].split()[:2] == ["b", "11"]
+
+    with t("b"):
+        pass
+
+    assert t.render(flat=True).splitlines()[3].split()[:2] == ["b", "12"]
+
 
 def test_render_on_exit():
     stream = io.StringIO()
@@ -214,3 +379,86 @@ def test_render_on_exit():
     captured = stream.getvalue().splitlines()
     assert len(captured) == 2
 
+
+def test_without_cpu_time():
+    t = Timer(cpu_time=False)
+
+    with t("a"):
+        with t("b"):
+            time.sleep(0.01)
+
+    assert t["b"].time >= 0.01
+    assert t["a"].cpu_time == 0.0
+    assert t["b"].own_cpu_time == 0.0
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(timer_module, "_enabled", True)
+    t = Timer()
+
+    Timer.disable_globally()
+    with t("a"):
+        with t:
+            pass
+
+    assert t.nodes == []
+    assert t.records == []
+
+    Timer.enable_globally()
+    with t("a"):
+        pass
+
+    assert t["a"].count == 1
+
+
+def test_toggle_inside_block(monkeypatch):
+    monkeypatch.setattr(timer_module, "_enabled", True)
+    t = Timer()
+
+    with t("a"):
+        Timer.disable_globally()
+    Timer.enable_globally()
+
+    with t("b"):
+        pass
+
+    Timer.disable_globally()
+    with t("c"):
+        with t:
+            Timer.enable_globally()
+
+    with t("d"):
+        func2(1, timer=t)
+
+    @timer()
+    def toggle() -> None:
+        Timer.disable_globally()
+
+    toggle(timer=t)
+    Timer.enable_globally()
+
+    assert [n.stack for n in t.nodes] == [("a",), ("b",), ("d",), ("d", "func2"), ("toggle",)]
+    assert [r.count for r in t.records] == [1, 1, 1, 1, 1]
+
+
+def test_render_on_del_skips_empty_timer():
+    stream = io.StringIO()
+    t = Timer(stream_on_del=stream)
+    del t
+
+    assert stream.getvalue() == ""
+
+
+def test_close():
+    stream = io.StringIO()
+    t = Timer(stream_on_del=stream)
+
+    with t("a"):
+        pass
+
+    t.close()
+    rendered = stream.getvalue()
+    assert len(rendered.splitlines()) == 3
+
+    del t
+    assert stream.getvalue() == rendered
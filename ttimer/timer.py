@@ -23,34 +23,60 @@ SOFTWARE.
 """
 from __future__ import annotations
 
-import copy
-import inspect
 import os
+import sys
 import threading
 import time
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass, fields
 from functools import wraps
-from logging import Logger
-from typing import IO, Any, Callable, Dict, Generator, List, Optional, Tuple, Union
-
-from anytree import NodeMixin, RenderTree
-from tabulate import tabulate
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+if TYPE_CHECKING:
+    from logging import Logger
 
 Func = Callable[..., Any]
+T = TypeVar("T")
 
+_REC_FIELDS = ("name", "count", "time", "own_time", "cpu_time", "own_cpu_time")
+_HEADERS = ("path", "count", "time", "own time", "cpu time", "own cpu time")
+
+# enter/exit events are buffered and folded into the tree lazily, at least this often
+_MAX_PENDING_EVENTS = 10000
+
+_enabled = os.environ.get("TTIMER_DISABLE", "") != "1"
+
+# integer nanosecond clocks; converted to float seconds only when folded into records
+_perf_counter_ns = time.perf_counter_ns
+_process_time_ns = time.process_time_ns
+
+# keyed by the values the name is built from, so that no code objects are kept alive
+_caller_names = {}  # type: Dict[Tuple[str, str, int], str]
 
-class StopWatch:
-    def __init__(self, name: str):
-        self.name = name
-        self.start = (time.perf_counter(), time.process_time())
-        self.elapsed_time = 0.0
-        self.elapsed_cpu_time = 0.0
 
-    def stop(self) -> None:
-        self.elapsed_time = time.perf_counter() - self.start[0]
-        self.elapsed_cpu_time = time.process_time() - self.start[1]
+def _add_slots(cls: Type[T]) -> Type[T]:
+    # equivalent of dataclass(slots=True), which is only available on Python 3.10+
+    field_names = tuple(f.name for f in fields(cls))  # type: ignore
+    cls_dict = dict(cls.__dict__)
+    cls_dict["__slots__"] = field_names
+    for name in field_names + ("__dict__", "__weakref__"):
+        cls_dict.pop(name, None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)  # type: ignore
 
 
+@_add_slots
 @dataclass
 class Record:
     name: str
@@ -60,16 +86,16 @@ class Record:
     cpu_time: float = 0.0
     own_cpu_time: float = 0.0
 
-    def on_stop(self, stop_watch: StopWatch) -> None:
-        self.time += stop_watch.elapsed_time
-        self.own_time += stop_watch.elapsed_time
-        self.cpu_time += stop_watch.elapsed_cpu_time
-        self.own_cpu_time += stop_watch.elapsed_cpu_time
+    def on_stop(self, elapsed_time: float, elapsed_cpu_time: float) -> None:
+        self.time += elapsed_time
+        self.own_time += elapsed_time
+        self.cpu_time += elapsed_cpu_time
+        self.own_cpu_time += elapsed_cpu_time
         self.count += 1
 
-    def on_stop_child(self, stop_watch: StopWatch) -> None:
-        self.own_time -= stop_watch.elapsed_time
-        self.own_cpu_time -= stop_watch.elapsed_cpu_time
+    def on_stop_child(self, elapsed_time: float, elapsed_cpu_time: float) -> None:
+        self.own_time -= elapsed_time
+        self.own_cpu_time -= elapsed_cpu_time
 
     def merge(self, other: Record) -> None:
         self.time += other.time
@@ -78,130 +104,304 @@ class Record:
         self.own_cpu_time += other.own_cpu_time
         self.count += other.count
 
+    def _clone(self) -> Record:
+        return Record(self.name, self.count, self.time, self.own_time, self.cpu_time, self.own_cpu_time)
+
+    def reset(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.own_time = 0.0
+        self.cpu_time = 0.0
+        self.own_cpu_time = 0.0
+
+
+def _merge_records(name: str, records: List[Record]) -> Record:
+    count = 0
+    elapsed_time = own_time = cpu_time = own_cpu_time = 0.0
+    for r in records:
+        count += r.count
+        elapsed_time += r.time
+        own_time += r.own_time
+        cpu_time += r.cpu_time
+        own_cpu_time += r.own_cpu_time
+    return Record(name, count, elapsed_time, own_time, cpu_time, own_cpu_time)
+
 
-class Node(NodeMixin):  # type: ignore
-    def __init__(
-        self, stack: Tuple[str, ...], record: Record, parent: Optional[Node] = None
-    ):
-        super().__init__()
-        self.stack = stack
+def _rec_to_dict(record: Record) -> Dict[str, Any]:
+    # same result as dataclasses.asdict for our flat record, without the recursive copy
+    return {f: getattr(record, f) for f in _REC_FIELDS}
+
+
+class Node:
+    __slots__ = ("record", "parent", "children", "children_by_name", "_stack")
+
+    def __init__(self, record: Record, parent: Optional[Node] = None):
         self.record = record
+        self.children = []  # type: List[Node]
+        self.children_by_name = {}  # type: Dict[str, Node]
+        self._attach(parent)
+
+    def reset(self, name: str, parent: Optional[Node] = None) -> None:
+        self.record.reset(name)
+        self.children.clear()
+        self.children_by_name.clear()
+        self._attach(parent)
+
+    def _attach(self, parent: Optional[Node]) -> None:
         self.parent = parent
+        self._stack = None  # type: Optional[Tuple[str, ...]]
+        if parent is not None:
+            parent.children.append(self)
+            parent.children_by_name[self.record.name] = self
+
+    @property
+    def stack(self) -> Tuple[str, ...]:
+        if self._stack is None:
+            parent_stack = self.parent.stack if self.parent is not None else ()
+            self._stack = parent_stack + (self.record.name,)
+        return self._stack
 
 
 class TimerContext:
+    __slots__ = ("timer", "name")
+
     def __init__(self, timer: Timer, name: str):
         self.timer = timer
         self.name = name
 
     def __enter__(self) -> Timer:
-        self.timer._push(self.name)
-        return self.timer
+        timer = self.timer
+        timed = _enabled
+        timer._timed.append(timed)
+        if timed:
+            timer._push(self.name)
+        return timer
 
     def __exit__(self, *exc: Any) -> None:
-        self.timer._pop()
+        timer = self.timer
+        if timer._timed.pop():
+            timer._pop()
 
 
 class Timer:
     def __init__(self,
                  stream_on_del: Optional[Union[Logger, IO[str]]] = None,
                  stream_on_exit: Optional[Union[Logger, IO[str]]] = None,
-                 format_on_exit: Optional[str] = None
+                 format_on_exit: Optional[str] = None,
+                 cpu_time: bool = True
                  ):
-        self._watches = []  # type: List[StopWatch]
-        self._nodes = {}  # type: Dict[Tuple[str, ...], Node]
+        self._events = []  # type: List[Tuple[Optional[str], int, int]]
+        self._t0_stack = []  # type: List[int]
+        self._c0_stack = []  # type: List[int]
+        self._node_stack = []  # type: List[Node]
+        self._nodes = []  # type: List[Node]
+        self._roots = {}  # type: Dict[str, Node]
+        self._by_name = {}  # type: Dict[str, List[Node]]
+        self._records = None  # type: Optional[List[Record]]
+        self._rendered = {}  # type: Dict[bool, str]
+        self._contexts = {}  # type: Dict[str, TimerContext]
+        self._timed = []  # type: List[bool]
+        self._node_pool = []  # type: List[Node]
+        self._nodes_exposed = False
         self._stream_on_del = stream_on_del
         self._stream_on_exit = stream_on_exit
         self._format_on_exit = format_on_exit or "{name}: {time}sec\n"
+        self._cpu_time = cpu_time
+        self._closed = False
 
     def __call__(self, name: str = "") -> TimerContext:
-        return TimerContext(self, name or self._get_caller_name(2))
+        # one context per name, reused every time the same block is timed
+        name = sys.intern(name) if name else self._get_caller_name(2)
+        context = self._contexts.get(name)
+        if context is None:
+            context = self._contexts[name] = TimerContext(self, name)
+        return context
 
     def __enter__(self) -> Timer:
-        self._push(self._get_caller_name(2))
+        timed = _enabled
+        self._timed.append(timed)
+        if timed:
+            self._push(self._get_caller_name(2))
         return self
 
     def __exit__(self, *exc: Any) -> None:
-        self._pop()
+        # follow the decision made on entry, even if the global switch was flipped inside the block
+        if self._timed.pop():
+            self._pop()
 
     def __del__(self) -> None:
-        if self._stream_on_del:
-            self._write(self._stream_on_del, self.render())
+        # may run at interpreter shutdown or on a half-initialized instance; never raise from here
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def disable_globally() -> None:
+        global _enabled
+        _enabled = False
+
+    @staticmethod
+    def enable_globally() -> None:
+        global _enabled
+        _enabled = True
 
     def __getitem__(self, item: str) -> Record:
-        candidates = [r for k, r in self._nodes.items() if k[-1] == item]
+        self._flush()
+        candidates = self._by_name.get(item)
         if not candidates:
             raise KeyError(f"{item} not found")
-        record = copy.copy(candidates[0].record)
-        for c in candidates[1:]:
-            record.merge(c.record)
-        return record
+        if len(candidates) == 1:
+            return candidates[0].record._clone()
+        return _merge_records(item, [c.record for c in candidates])
 
     @property
     def trees(self) -> List[Node]:
-        return [n for n in self.nodes if not n.parent]
+        self._flush()
+        self._nodes_exposed = True
+        return list(self._roots.values())
 
     @property
     def nodes(self) -> List[Node]:
-        return list(self._nodes.values())
+        self._flush()
+        self._nodes_exposed = True
+        return list(self._nodes)
 
     @property
     def records(self) -> List[Record]:
-        return [self[k] for k in {k[-1]: None for k in self._nodes.keys()}.keys()]
+        self._flush()
+        if self._records is None:
+            self._records = [self[k] for k in self._by_name]
+        return [r._clone() for r in self._records]
+
+    def close(self) -> None:
+        if not self._closed and self._stream_on_del and (self._nodes or self._events):
+            self._write(self._stream_on_del, self.render())
+        self._closed = True
 
     def clear(self) -> None:
-        self._watches = []
-        self._nodes = {}
+        # recycle nodes (and their records) for later measurements,
+        # unless they have been handed out through .nodes or .trees
+        if not self._nodes_exposed:
+            self._node_pool.extend(self._nodes)
+        self._nodes_exposed = False
+        self._events = []
+        self._t0_stack = []
+        self._c0_stack = []
+        self._node_stack = []
+        self._nodes = []
+        self._roots = {}
+        self._by_name = {}
+        self._records = None
+        self._rendered = {}
 
     def render(self, flat: bool = False) -> str:
-        rendered = []
-
-        for pre, _, rec in self._iterate_nodes(flat):
-            rendered.append(
-                [
-                    pre + rec.name,
-                    rec.count,
-                    rec.time,
-                    rec.own_time,
-                    rec.cpu_time,
-                    rec.own_cpu_time,
-                ]
+        self._flush()
+        if flat in self._rendered:
+            return self._rendered[flat]
+
+        rows = [
+            (
+                pre + rec.name,
+                str(rec.count),
+                f"{rec.time:g}",
+                f"{rec.own_time:g}",
+                f"{rec.cpu_time:g}",
+                f"{rec.own_cpu_time:g}",
             )
-
-        return tabulate(
-            rendered,
-            headers=["path", "count", "time", "own time", "cpu time", "own cpu time"],
+            for pre, _, rec in self._iterate_nodes(flat)
+        ]
+        widths = [
+            max([len(header)] + [len(row[i]) for row in rows])
+            for i, header in enumerate(_HEADERS)
+        ]
+
+        path_width, *value_widths = widths
+        lines = [_HEADERS, tuple("-" * w for w in widths)] + rows
+        rendered = "\n".join(
+            "  ".join([path.ljust(path_width)] + [v.rjust(w) for v, w in zip(values, value_widths)])
+            for path, *values in lines
         )
+        self._rendered[flat] = rendered
+        return rendered
 
     def to_dict(self, flat: bool = False) -> List[Dict[str, Any]]:
         list_of_dict = []
+        rec_to_dict = _rec_to_dict
         for _, stack, rec in self._iterate_nodes(flat):
-            d = asdict(rec)
+            d = rec_to_dict(rec)
             if not flat:
                 d["stack"] = stack
             list_of_dict.append(d)
         return list_of_dict
 
     def _push(self, name: str) -> None:
-        parent = self._nodes.get(self._stack)
-
-        self._watches.append(StopWatch(name))
-        if self._stack not in self._nodes:
-            self._nodes[self._stack] = Node(
-                self._stack, Record(self._stack[-1]), parent=parent
-            )
+        self._events.append((name, _perf_counter_ns(), _process_time_ns() if self._cpu_time else 0))
 
     def _pop(self) -> None:
-        self._current_watch.stop()
-
-        self._current_node.record.on_stop(self._current_watch)
-        if self._current_node.parent:
-            self._current_node.parent.record.on_stop_child(self._current_watch)
+        events = self._events
+        events.append((None, _perf_counter_ns(), _process_time_ns() if self._cpu_time else 0))
 
         if self._stream_on_exit:
-            self._write(self._stream_on_exit, self._format_on_exit.format(**asdict(self._current_node.record)))
-
-        self._watches.pop()
+            node = self._flush()
+            assert node is not None
+            self._write(self._stream_on_exit, self._format_on_exit.format(**_rec_to_dict(node.record)))
+        elif len(events) >= _MAX_PENDING_EVENTS:
+            self._flush()
+
+    def _flush(self) -> Optional[Node]:
+        # replay the buffered enter/exit events into the tree, returning the last node touched
+        events = self._events
+        if not events:
+            return None
+
+        node_stack = self._node_stack
+        t0_stack = self._t0_stack
+        c0_stack = self._c0_stack
+        node = None
+        for name, t, c in events:
+            if name is not None:
+                node = self._get_node(name, node_stack[-1] if node_stack else None)
+                node_stack.append(node)
+                t0_stack.append(t)
+                c0_stack.append(c)
+            else:
+                node = node_stack.pop()
+                elapsed_time = (t - t0_stack.pop()) * 1e-9
+                elapsed_cpu_time = (c - c0_stack.pop()) * 1e-9
+
+                # inlined Record.on_stop / on_stop_child
+                rec = node.record
+                rec.time += elapsed_time
+                rec.own_time += elapsed_time
+                rec.cpu_time += elapsed_cpu_time
+                rec.own_cpu_time += elapsed_cpu_time
+                rec.count += 1
+                parent = node.parent
+                if parent is not None:
+                    rec = parent.record
+                    rec.own_time -= elapsed_time
+                    rec.own_cpu_time -= elapsed_cpu_time
+
+        events.clear()
+        self._records = None
+        self._rendered.clear()
+        return node
+
+    def _get_node(self, name: str, parent: Optional[Node]) -> Node:
+        node = (parent.children_by_name if parent is not None else self._roots).get(name)
+        if node is None:
+            if self._node_pool:
+                node = self._node_pool.pop()
+                node.reset(name, parent)
+            else:
+                node = Node(Record(name), parent=parent)
+            if parent is None:
+                self._roots[name] = node
+            self._nodes.append(node)
+            self._by_name.setdefault(name, []).append(node)
+        return node
 
     def _iterate_nodes(
         self, flat: bool = False
@@ -210,35 +410,39 @@ class Timer:
             for record in self.records:
                 yield "", ("",), record
         else:
-            for root in self.trees:
-                for pre, _, node in RenderTree(root):
-                    yield pre, node.stack, node.record
-
-    @property
-    def _current_node(self) -> Node:
-        return self._nodes[self._stack]
-
-    @property
-    def _current_watch(self) -> StopWatch:
-        assert self._watches
-        return self._watches[-1]
-
-    @property
-    def _stack(self) -> Tuple[str, ...]:
-        return tuple([t.name for t in self._watches])
+            # explicit DFS stack of (node, prefix of the node, prefix of its children)
+            self._flush()
+            pending = [(root, "", "") for root in reversed(list(self._roots.values()))]
+            while pending:
+                node, pre, fill = pending.pop()
+                yield pre, node.stack, node.record
+
+                children = node.children
+                if children:
+                    pending.append((children[-1], fill + "└── ", fill + "    "))
+                    pending.extend((c, fill + "├── ", fill + "│   ") for c in reversed(children[:-1]))
 
     def _get_caller_name(self, index: int) -> str:
         try:
-            callee = inspect.stack()[index]
-            return f"{callee.function}({os.path.basename(callee.filename)}:{callee.lineno})"
-        except Exception:
+            frame = sys._getframe(index)
+        except ValueError:
             return "(unknown)"
 
+        code = frame.f_code
+        key = (code.co_filename, code.co_name, frame.f_lineno)
+        name = _caller_names.get(key)
+        if name is None:
+            name = sys.intern(f"{code.co_name}({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            _caller_names[key] = name
+        return name
+
     def _write(self, stream: Union[Logger, IO[str]], content: str) -> None:
-        if isinstance(stream, Logger):
+        # a Logger can only exist if logging has been imported, so don't import it ourselves
+        logging = sys.modules.get("logging")
+        if logging is not None and isinstance(stream, logging.Logger):
             stream.info(content)
         else:
-            stream.write(content)
+            stream.write(content)  # type: ignore
 
 
 _thread_local = threading.local()
@@ -260,6 +464,8 @@ def get_timers() -> Dict[str, Timer]:
 
 def timer(timer_name: Optional[str] = None) -> Func:
     def _timer(func: Func) -> Func:
+        name = sys.intern(func.__name__)
+
         @wraps(func)
         def _inner(*args: Any, **kws: Any) -> Any:
             if timer_name is None:
@@ -267,15 +473,20 @@ def timer(timer_name: Optional[str] = None) -> Func:
                     "Without specifying timer_name, "
                     "you will need to pass the timer with an extra keyword argument"
                 )
-                timer = kws["timer"]
+                timer = kws.pop("timer")
                 assert isinstance(timer, Timer)
-                kws.pop("timer")
             else:
                 timer = get_timer(timer_name)
 
-            with timer(func.__name__):
-                result = func(*args, **kws)
-            return result
+            if not _enabled:
+                return func(*args, **kws)
+
+            # same as "with timer(name):", minus the pending-name round trip
+            timer._push(name)
+            try:
+                return func(*args, **kws)
+            finally:
+                timer._pop()
 
         return _inner
 